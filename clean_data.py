@@ -13,28 +13,45 @@ import pandas as pd
 from sklearn.preprocessing import Imputer
 from sklearn.neighbors import KernelDensity
 
+import point_store
+
 DATA_DIR = "Data"
 EMME_VOLUME_DATA = os.path.join(DATA_DIR, "EMME 2011 VOLUME SUMMARY.OCT2015.v2.csv")
 EMME_LINK_DATA = os.path.join(DATA_DIR, "EMME_link_data.csv")
 RAW_DATA_DIR = os.path.join(DATA_DIR, "Geoprocessed Data", "Processed CSVs")
 CLEANED_DATA_DIR = os.path.join(DATA_DIR, "Cleaned Data")
+CLEANED_STORE_DIR = os.path.join(CLEANED_DATA_DIR, "cleaned_store")
 
 
-def clean_trips(directory_name, cache_file=None, clean_users=True):
+def clean_trips(directory_name, cache_file=None, clean_users=True, age_bandwidth=5.0,
+                store_dir=None):
     """Returns a Pandas dataframe of cleaned, aggregated trips from a directory.
+
+    The cleaned data is written to cache_file as a CSV and, if store_dir is
+    given, to a memory-mapped columnar store (see point_store).
     """
 
     csv_list = [os.path.join(directory_name, f) for f in os.listdir(directory_name) 
                 if os.path.splitext(f)[1] == ".csv"]
     print("Reading in data")
-    df_list = [pd.read_csv(csv, parse_dates=["STARTED_AT"])
-               for csv in csv_list]
+    df_list = [read_trip(csv) for csv in csv_list]
     print("Cleaning trips")
     data = pd.concat([clean_trip(d) for d in df_list])
-    data = clean_data(data, clean_users=clean_users)
+    data = clean_data(data, clean_users=clean_users, age_bandwidth=age_bandwidth)
     print("Writing cleaned data to %s" % cache_file)
     data.to_csv(cache_file, encoding="utf8")
     print("Successfully wrote data to csv")
+    if store_dir is not None:
+        print("Writing cleaned data store to %s" % store_dir)
+        point_store.write_store(data, store_dir)
+    return data
+
+
+def read_trip(csv):
+    """Reads the CSV of a single processed trip, named by its trip ID"""
+    df = pd.read_csv(csv, parse_dates=["STARTED_AT", "RECORDED_A"])
+    df["TRIP_ID"] = int(os.path.splitext(os.path.basename(csv))[0])
+    return df
 
 
 def clean_trip(df):
@@ -159,8 +176,10 @@ def filter_missing_survey_vals(df):
     return df
 
 
-def clean_data(data, clean_users=True):
+def clean_data(data, clean_users=True, age_bandwidth=5.0):
     """Cleans the input point speed dataset
+
+    age_bandwidth is the bandwidth of the KDE used by estimate_user_age_dist
     """
     print("Ading bike codes")
     data = add_bike_code(data)
@@ -175,7 +194,7 @@ def clean_data(data, clean_users=True):
         print("Adding user stats")
         data = add_user_stat(data)
         print("Performing user age estimate")
-        data = estimate_user_age_dist(data, bandwidth=5.0)
+        data = estimate_user_age_dist(data, bandwidth=age_bandwidth)
         print("Filtering out missing values from user survey")
         #data = filter_missing_survey_vals(data)
 
@@ -184,7 +203,7 @@ def clean_data(data, clean_users=True):
 
 if __name__ == "__main__":
     cached_cleaned = os.path.join(CLEANED_DATA_DIR, "cleaned_data.csv")
-    clean_trips(RAW_DATA_DIR, cache_file=cached_cleaned)
+    clean_trips(RAW_DATA_DIR, cache_file=cached_cleaned, store_dir=CLEANED_STORE_DIR)
 
 
 
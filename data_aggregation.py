@@ -7,6 +7,7 @@ Created on Jul 16, 2017
 import os
 import xml.etree.ElementTree as ET
 import csv
+import multiprocessing
 import re
 import unicodedata
 
@@ -14,42 +15,132 @@ import arcpy
 
 SPATIAL_REF = arcpy.SpatialReference("WGS 1984")
 #SPATIAL_REF = arcpy.SpatialReference("NAD_1983_UTM_Zone_17N")
-NETWORK_GDB = r"D:\UofT 2016\Speed Analysis\toronto-cycling-speed-analysis\Data\cycling-network.gdb"
-CENTRELINE_INTERSECTION = r"D:\UofT 2016\Bike App Data\Road - Intersections\CENTRELINE_INTERSECTION_simplified.shp"
+DATA_FOLDER = r"D:\UofT 2016\Speed Analysis\toronto-cycling-speed-analysis\Data"
+# When run by pipeline.py, the input and output paths come from the environment
+NETWORK_GDB = os.environ.get("STOPS_GDB", os.path.join(DATA_FOLDER, "cycling-network.gdb"))
+CENTRELINE_INTERSECTION = os.environ.get("CENTRELINE_INTERSECTION",
+        r"D:\UofT 2016\Bike App Data\Road - Intersections\CENTRELINE_INTERSECTION_simplified.shp")
 STOP_SIGNS_FILE = NETWORK_GDB + r"\Centreline_Stopsigns"
+STOPS_XML = os.environ.get("STOPS_XML",
+        os.path.join(DATA_FOLDER, "Chapter_950", "Ch_950_Sch_27_CompulsoryStops.xml"))
+FILTERED_STOPS_CSV = os.environ.get("FILTERED_STOPS_CSV",
+        os.path.join(DATA_FOLDER, "Stop Signs (filtered).csv"))
+STOPS_CSV = os.environ.get("STOPS_CSV", os.path.join(DATA_FOLDER, "Stop Signs.csv"))
+UNMATCHED_STOPS_CSV = os.environ.get("UNMATCHED_STOPS_CSV",
+        os.path.join(DATA_FOLDER, "Stop Signs (unmatched).csv"))
+GEOCODE_BATCH_SIZE = 200
+GEOCODE_WORKERS = 4
 
 def convert_stops_to_shapefile():
     arcpy.env.overwriteOutput = True
-    stops_csv = r'D:\UofT 2016\Speed Analysis\toronto-cycling-speed-analysis\Data\Stop Signs (filtered).csv'
-    
-    arcpy.management.MakeXYEventLayer(stops_csv, "Longitude", "Latitude",
+    arcpy.management.MakeXYEventLayer(FILTERED_STOPS_CSV, "Longitude", "Latitude",
                                       "od", SPATIAL_REF)
     arcpy.conversion.FeatureClassToFeatureClass("od", NETWORK_GDB, "stop_signs")
 
 
-def pull_stops_to_csv():
-    stops_xml = r'D:\UofT 2016\Speed Analysis\toronto-cycling-speed-analysis\Data\Chapter_950\Ch_950_Sch_27_CompulsoryStops.xml'
-    stops_csv = r'D:\UofT 2016\Speed Analysis\toronto-cycling-speed-analysis\Data\Stop Signs.csv'
-    stops_tree = ET.parse(stops_xml)
-    
+def pull_stops_to_csv(stops_xml=STOPS_XML, stops_csv=STOPS_CSV, unmatched_csv=UNMATCHED_STOPS_CSV):
+    """Geocodes the compulsory stops in the by-law schedule and writes them to a CSV
+
+    The schedule is streamed twice rather than loaded into memory. The first
+    pass collects the unique (stop street, cross street) pairs, which are
+    geocoded in batches across a pool of worker processes; the second pass
+    writes a row per stop using the geocoded pairs. Pairs that couldn't be
+    found are written to a separate report instead of being printed.
+    """
+    print("Collecting intersections from %s" % stops_xml)
+    pairs = {}
+    num_stops = 0
+    for intersection_field, stop_street_field in iter_stop_records(stops_xml):
+        names = parse_stop_names(intersection_field, stop_street_field)
+        pair = names[:2]
+        if pair in pairs:
+            pairs[pair][0] += 1
+        else:
+            pairs[pair] = [1, intersection_field, stop_street_field]
+        num_stops += 1
+    print("Geocoding %d unique intersections from %d stops" % (len(pairs), num_stops))
+
+    locations = geocode_intersections(list(pairs))
+    unmatched = [pair + tuple(pairs[pair]) for pair in pairs if locations[pair] is None]
+    with open(unmatched_csv, 'wb') as unmatched_file:
+        unmatched_writer = csv.writer(unmatched_file)
+        unmatched_writer.writerow(("Stop Street", "Cross Street", "Number of Stops",
+                                   "Intersection", "Stop Street or Highway"))
+        unmatched_writer.writerows(unmatched)
+    print("Couldn't find %d intersections, see %s" % (len(unmatched), unmatched_csv))
+
     with open(stops_csv, 'wb') as stops_file:
-        stops_csv = csv.writer(stops_file)
-        stops_csv.writerow(("Stop Street", "Cross Street", 
-                            "Stop Street Location Details", "Cross Street Location Details",
-                            "Has lat/lon coordinates", "Longitude", "Latitude"))
-        for num, child in enumerate(stops_tree.findall("Ch_950_Sch_27_CompulsoryStops")):
-            try:
-                elements = get_intersec_elements(child.find('Intersection').text,
-                                                 child.find('Stop_Street_or_Highway').text)
-                #print(elements)
-                stops_csv.writerow(elements)
-            except AttributeError: # The xml element doesn't have one of the attributes (likely 'Stop_Street_or_Highway')
-                pass
-            #if num > 500:
-            #    break
-    print("Done pulling stops!")  
-    
+        stops_writer = csv.writer(stops_file)
+        stops_writer.writerow(("Stop Street", "Cross Street", 
+                               "Stop Street Location Details", "Cross Street Location Details",
+                               "Has lat/lon coordinates", "Longitude", "Latitude"))
+        stops_writer.writerows(_stop_row(parse_stop_names(*record), locations)
+                               for record in iter_stop_records(stops_xml))
+    print("Done pulling stops!")
+
+
+def _stop_row(names, locations):
+    latlon = locations[names[:2]]
+    if latlon is None:
+        return names + (False, "", "")
+    return names + (True, latlon[1], latlon[0])
+
+
+def iter_stop_records(stops_xml):
+    """Yields the intersection and stop street text of each stop in the schedule
+
+    Elements are cleared as soon as they're read, so memory use doesn't
+    grow with the size of the file. Stops missing either field are skipped.
+    """
+    root = None
+    for event, elem in ET.iterparse(stops_xml, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event != "end" or elem.tag != "Ch_950_Sch_27_CompulsoryStops":
+            continue
+        intersection_field = elem.findtext("Intersection")
+        stop_street_field = elem.findtext("Stop_Street_or_Highway")
+        elem.clear()
+        root.clear()
+        if intersection_field is not None and stop_street_field is not None:
+            yield intersection_field, stop_street_field
+
+
+def geocode_intersections(pairs, batch_size=GEOCODE_BATCH_SIZE, workers=GEOCODE_WORKERS):
+    """Returns a dict of (stop street, cross street) pairs to their (lat, lon)
+
+    Pairs are split into batches and geocoded by a pool of worker processes.
+    Pairs that couldn't be found map to None.
+    """
+    batches = [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        locations = {}
+        for i, batch_locations in enumerate(pool.imap_unordered(_geocode_batch, batches)):
+            locations.update(batch_locations)
+            print("Geocoded %d of %d batches" % (i + 1, len(batches)))
+    finally:
+        pool.close()
+        pool.join()
+    return locations
+
+
+def _geocode_batch(pairs):
+    return [(pair, get_intersection_gps(*pair)) for pair in pairs]
+
+
 def get_intersec_elements(intersection_field, stop_street_field):
+    """Parses and geocodes a single stop, returning a row of the stops CSV"""
+    names = parse_stop_names(intersection_field, stop_street_field)
+    return _stop_row(names, {names[:2]: get_intersection_gps(*names[:2])})
+
+
+def parse_stop_names(intersection_field, stop_street_field):
+    """Splits the fields of a stop into the network's street names and location details
+
+    Returns a tuple of the stop street, the cross street and the extra
+    location details given in brackets for each.
+    """
     try:
         intersection_field = unicodedata.normalize('NFKD', intersection_field)
         intersection_field = intersection_field.decode("windows-1252")
@@ -83,19 +174,7 @@ def get_intersec_elements(intersection_field, stop_street_field):
     
     stop_street = stop_names_to_shape_names(stop_street)
     cross_street = stop_names_to_shape_names(cross_street)
-    latlon = get_intersection_gps(stop_street, cross_street)
-    
-    if latlon is None:
-        print "Can't find intersection %s - %s :(" % (stop_street, cross_street)
-        print intersection_field, stop_street_field
-        has_latlon = False
-        lat = ""
-        lon = ""
-    else:
-        has_latlon = True
-        lat = latlon[0]
-        lon = latlon[1]
-    return (stop_street, cross_street, stop_street_info, cross_street_info, has_latlon, lon, lat)
+    return (stop_street, cross_street, stop_street_info, cross_street_info)
     
 
 def stop_names_to_shape_names(street_name):
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Density plots of the full point dataset from pre-binned 2D grids
+
+Handing millions of points to hexbin, scatter or a KDE jointplot takes
+minutes and gigabytes, so instead the points are counted into a fixed grid
+in chunks (in parallel, with flat memory use) and only the grid is drawn.
+Grids over the same extent can be added together, and grids binned from a
+point store can be cached to disk.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+DEFAULT_BINS = (200, 200)
+CHUNK_SIZE = 1000000
+GRID_CACHE_DIR = os.path.join("Data", "Density Grids")
+
+
+class DensityGrid(object):
+    """Counts of points in a fixed grid of bins over x_range by y_range
+
+    Points outside the ranges (or with NaN coordinates) are not counted.
+    """
+
+    def __init__(self, x_range, y_range, bins=DEFAULT_BINS, counts=None):
+        self.x_range = tuple(float(v) for v in x_range)
+        self.y_range = tuple(float(v) for v in y_range)
+        self.bins = tuple(int(b) for b in bins)
+        if counts is None:
+            counts = np.zeros(self.bins, dtype=np.int64)
+        self.counts = counts
+
+    @property
+    def x_edges(self):
+        return np.linspace(self.x_range[0], self.x_range[1], self.bins[0] + 1)
+
+    @property
+    def y_edges(self):
+        return np.linspace(self.y_range[0], self.y_range[1], self.bins[1] + 1)
+
+    def bin_indices(self, values, value_range, n_bins):
+        """Returns the bin index of each value, with -1 for values outside the range"""
+        lower, upper = value_range
+        values = np.asarray(values, dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            indices = np.floor((values - lower) * (n_bins / (upper - lower)))
+            indices[values == upper] = n_bins - 1
+            indices[~((indices >= 0) & (indices < n_bins))] = -1
+        return indices.astype(np.intp)
+
+    def count(self, x, y):
+        """Returns the grid counts of a chunk of points, without adding them"""
+        ix = self.bin_indices(x, self.x_range, self.bins[0])
+        iy = self.bin_indices(y, self.y_range, self.bins[1])
+        inside = (ix >= 0) & (iy >= 0)
+        flat = ix[inside] * self.bins[1] + iy[inside]
+        return np.bincount(flat, minlength=self.bins[0] * self.bins[1]).reshape(self.bins)
+
+    def add(self, x, y):
+        self.counts += self.count(x, y)
+        return self
+
+    def _check_compatible(self, other):
+        if (self.x_range, self.y_range, self.bins) != (other.x_range, other.y_range, other.bins):
+            raise ValueError("Can't merge density grids with different extents or bins")
+
+    def __add__(self, other):
+        self._check_compatible(other)
+        return DensityGrid(self.x_range, self.y_range, self.bins, self.counts + other.counts)
+
+    def __iadd__(self, other):
+        self._check_compatible(other)
+        self.counts += other.counts
+        return self
+
+    def save(self, filename):
+        np.savez(filename, x_range=self.x_range, y_range=self.y_range,
+                 bins=self.bins, counts=self.counts)
+
+    @classmethod
+    def load(cls, filename):
+        grid_file = np.load(filename)
+        return cls(grid_file["x_range"], grid_file["y_range"],
+                   grid_file["bins"], grid_file["counts"])
+
+
+def bin_points(x, y, x_range, y_range, bins=DEFAULT_BINS, chunk_size=CHUNK_SIZE, workers=None):
+    """Counts points into a DensityGrid, a chunk at a time across a thread pool
+
+    x and y can be any sliceable arrays, including memory-mapped columns,
+    so only a chunk of each needs to be in memory per thread.
+    """
+    grid = DensityGrid(x_range, y_range, bins)
+    chunks = [slice(start, start + chunk_size) for start in range(0, len(x), chunk_size)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for counts in executor.map(lambda rows: grid.count(x[rows], y[rows]), chunks):
+            grid.counts += counts
+    return grid
+
+
+def bin_store(store, x_col, y_col, x_range, y_range, bins=DEFAULT_BINS,
+              cache_dir=GRID_CACHE_DIR, **kwargs):
+    """Bins two columns of a point store, reusing a cached grid if there is one
+
+    The cache is keyed on the size and modification time of the two column
+    files and on the grid extent, so rewriting either column (or asking for
+    a different extent) gets a new grid.
+    """
+    column_stamps = []
+    for col in (x_col, y_col):
+        col_path = store.column_path(col)
+        st = os.stat(col_path)
+        column_stamps.append([os.path.abspath(col_path), st.st_size, st.st_mtime_ns])
+    key_data = json.dumps([column_stamps, list(x_range), list(y_range), list(bins)])
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "%s_%s_%s.npz" % (
+            x_col, y_col, hashlib.sha1(key_data.encode("utf8")).hexdigest()[:16]))
+        if os.path.exists(cache_file):
+            return DensityGrid.load(cache_file)
+
+    grid = bin_points(store.array(x_col), store.array(y_col), x_range, y_range, bins, **kwargs)
+    if cache_file is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        grid.save(cache_file)
+    return grid
+
+
+def plot_density(grid, ax=None, log=True, cmap=plt.cm.YlOrRd):
+    """Draws a grid as a heatmap, returning the mesh (e.g. for plt.colorbar)
+
+    With log=True the colour scale is logarithmic and empty bins are left blank.
+    """
+    ax = ax or plt.gca()
+    counts = np.ma.masked_equal(grid.counts, 0) if log else grid.counts
+    norm = LogNorm() if log else None
+    mesh = ax.pcolormesh(grid.x_edges, grid.y_edges, counts.T, cmap=cmap, norm=norm)
+    ax.set_xlim(grid.x_range)
+    ax.set_ylim(grid.y_range)
+    return mesh
+
+
+def joint_density(grid, log=True, cmap=plt.cm.YlOrRd):
+    """Draws a grid as a heatmap with marginal histograms, like a seaborn jointplot
+
+    Returns the figure and its joint, top and right axes.
+    """
+    fig = plt.figure(figsize=(6, 6))
+    ax_joint = fig.add_axes([0.12, 0.1, 0.65, 0.65])
+    ax_x = fig.add_axes([0.12, 0.77, 0.65, 0.18], sharex=ax_joint)
+    ax_y = fig.add_axes([0.79, 0.1, 0.18, 0.65], sharey=ax_joint)
+    plot_density(grid, ax=ax_joint, log=log, cmap=cmap)
+
+    x_counts = grid.counts.sum(axis=1)
+    y_counts = grid.counts.sum(axis=0)
+    ax_x.bar(grid.x_edges[:-1], x_counts, width=np.diff(grid.x_edges), align="edge")
+    ax_y.barh(grid.y_edges[:-1], y_counts, height=np.diff(grid.y_edges), align="edge")
+    for ax in (ax_x, ax_y):
+        ax.set_axis_off()
+    return fig, ax_joint, ax_x, ax_y
@@ -10,6 +10,7 @@ import shutil
 import datetime as dt
 import traceback
 
+import numpy as np
 import arcpy
 import arcgisscripting
 
@@ -20,20 +21,33 @@ arcpy.env.overwriteOutput = True
 arcpy.CheckOutExtension("Network")
 
 DATA_FOLDER = r"D:\UofT 2016\Speed Analysis\toronto-cycling-speed-analysis\Data"
-INPUT_DIR = os.path.join(DATA_FOLDER, "Cut Data")
-#OUTPUT_CSV_FOLDER = os.path.join(DATA_FOLDER, "Geoprocessed Data", "Processed CSVs")
+# When run by pipeline.py, the input and output paths come from the environment
+INPUT_DIR = os.environ.get("CUT_DATA_DIR", os.path.join(DATA_FOLDER, "Cut Data"))
+OUTPUT_CSV_FOLDER = os.environ.get("PROCESSED_CSV_DIR",
+        os.path.join(DATA_FOLDER, "Geoprocessed Data", "Processed CSVs"))
 SF_DIR = os.path.join(DATA_FOLDER, "Geoprocessed Data", "Shapefiles")
-OUTPUT_CSV_FOLDER = os.path.join(DATA_FOLDER, "Geoprocessed Data", "Processed CSVs - New")
 #SF_DIR = os.path.join(DATA_FOLDER, "Geoprocessed Data", "Shapefiles - New")
 
-NETWORK_GDB = r"D:\UofT 2016\Kathryn Choiceset Generation\Network_with_Emme\CalibratedNetworkJuly26\CalibratedNetworkJuly26.gdb"
+NETWORK_GDB = os.environ.get("NETWORK_GDB",
+        r"D:\UofT 2016\Kathryn Choiceset Generation\Network_with_Emme\CalibratedNetworkJuly26\CalibratedNetworkJuly26.gdb")
 NETWORK_DATASET = NETWORK_GDB + r"\dataset\dataset_ND"
 CENTRELINE_LINKS = NETWORK_GDB + r"\dataset\Calibrated_July26"
 SIGNALIZED_INTERSECTION_PATH = NETWORK_GDB + r"\Centreline_JunctionswithSignals"
 STOP_SIGNS_FILE = NETWORK_GDB + r"\stop_signs"
+LINK_ID_FIELD = "OBJECTID_12"
+LINK_TABLE = os.path.join(DATA_FOLDER, "Geoprocessed Data", "link_attributes.npy")
+# Link fields read by match_route_direction and export_features_to_csv, with
+# the (10 character) names they have in the route shapefiles
+LINK_FIELDS = (("LF_NAME", "LF_NAME"), ("ONE_WAY_DIR", "ONE_WAY_DI"), ("SLOPE_TF", "SLOPE_TF"),
+               ("Shape_Length", "Shape_Leng"), ("RDCLASS", "RDCLASS"),
+               ("Bike_Class", "Bike_Class"), ("Bike_Code", "Bike_Code"),
+               ("EMME_MATCH", "EMME_MATCH"), ("EMME_CONTR", "EMME_CONTR"),
+               ("FNODE", "FNODE"), ("TNODE", "TNODE"))
 
 ACCUMULATORS = ("Meters",)
 
+_link_table = None
+
 
 def solve_trip(observed_points, od_points, trip_id, results_folder, BUFF_SIZE=50):
     """Solves an observed route and returns the split result
@@ -72,8 +86,7 @@ def solve_trip(observed_points, od_points, trip_id, results_folder, BUFF_SIZE=50
 
     obs_path_name = os.path.join(SF_DIR, trip_id+"_observed_route.shp")
     try:
-        split_route = get_split_solved_route(NALayer, obs_path_name, results_folder, trip_id, 
-                copy_id="OBJECTID_12")
+        split_route = get_split_solved_route(NALayer, obs_path_name, results_folder, trip_id)
     except:
         if BUFF_SIZE == 50:
             solve_trip(observed_points, od_points, trip_id, results_folder, BUFF_SIZE=100)
@@ -140,17 +153,17 @@ def add_stopsign_distances(observed_points, route):
     arcpy.management.CalculateField(observed_points, "stop_dist",
                                     "!NEAR_DIST!", "PYTHON_9.3")
 
-def get_split_solved_route(na_layer, split_route_output, results_folder, trip_id, 
-        copy_id="OBJECTID"):
+def get_split_solved_route(na_layer, split_route_output, results_folder, trip_id):
     """Solves a route setup in a network dataset, splits it, and writes it to a file.
 
+    The attributes of each traversed link are attached from the table written
+    by export_link_attributes.
+
     parameters
     na_layer: A string containing the path to the network analysis layer with 
         route information input
     split_route_output: The name of the particular route being solved
     trip_id: The ID of the trip
-    copy_id: The name of the index in the dataset used to generate the network
-        dataset (the dataset being assumed to be CENTRELINE_LINKS)
     """
     print "Solve and split route"
     try:
@@ -164,10 +177,55 @@ def get_split_solved_route(na_layer, split_route_output, results_folder, trip_id
         arcpy.management.Delete(junctions_name)
         arcpy.management.Delete(turns_name)
 
-    arcpy.management.JoinField(split_route_output, "SourceOID", CENTRELINE_LINKS, copy_id)
+    route_oids = arcpy.da.TableToNumPyArray(split_route_output, "SourceOID")["SourceOID"]
+    link_attributes = load_link_attributes()[np.unique(route_oids)]
+    arcpy.da.ExtendTable(split_route_output, "SourceOID", link_attributes, "SourceOID")
     return split_route_output
 
 
+def export_link_attributes(id_field=LINK_ID_FIELD, out_file=LINK_TABLE):
+    """Exports the attributes of every link in CENTRELINE_LINKS to a numpy table
+
+    Joining CENTRELINE_LINKS onto each solved route scans the whole network
+    for every trip, so instead the link fields that are used later (see
+    LINK_FIELDS) are exported once into a structured array where row i
+    holds the link with id i (the id being the field used to generate the
+    network dataset, which the solved route's SourceOID refers to). Ids with
+    no link get zeroed rows. Fields are named as they appear in the route
+    shapefiles, so they're added to the routes under those names.
+    """
+    print("Exporting link attributes from %s" % CENTRELINE_LINKS)
+    field_types = dict((f.name, f.type) for f in arcpy.ListFields(CENTRELINE_LINKS))
+    null_values = dict((name, "" if field_types[name] == "String" else 0)
+                       for name, _ in LINK_FIELDS)
+    null_values[id_field] = -1
+    links = arcpy.da.TableToNumPyArray(CENTRELINE_LINKS,
+                                       [id_field] + [name for name, _ in LINK_FIELDS],
+                                       null_value=null_values)
+    links = links[links[id_field] >= 0]
+
+    dtype = [("SourceOID", np.int32)] + [(shp_name, links.dtype[name])
+                                         for name, shp_name in LINK_FIELDS]
+    table = np.zeros(links[id_field].max() + 1, dtype=dtype)
+    table["SourceOID"] = np.arange(len(table))
+    for name, shp_name in LINK_FIELDS:
+        table[shp_name][links[id_field]] = links[name]
+    np.save(out_file, table)
+    print("Wrote attributes of %d links to %s" % (len(links), out_file))
+
+
+def load_link_attributes(link_file=LINK_TABLE):
+    """Returns the link attribute table, memory-mapped read-only
+
+    The table is only opened once per process, and processes reading it
+    share the same pages.
+    """
+    global _link_table
+    if _link_table is None:
+        _link_table = np.load(link_file, mmap_mode="r")
+    return _link_table
+
+
 def match_route_direction(route):
     """Adds field to route indicating if edge follows digitization
 
@@ -251,25 +309,17 @@ if __name__ == '__main__':
 
     start_t = dt.datetime.now()
 
+    export_link_attributes()
     trip_ids = set([os.path.splitext(f)[0] for f in os.listdir(INPUT_DIR) if not "_od.csv" in f])
     print("Beginning to process %d trips from %s" % (len(trip_ids), INPUT_DIR))
     for i, trip_id in enumerate(trip_ids):
         print("\nProcessing trip %s" % trip_id)
-        '''
         try:
             all_points, od_points = csv_to_shapefiles(trip_id)
             solve_trip(all_points, od_points, trip_id, OUTPUT_CSV_FOLDER)
         except:
             print("ERROR: Trip %s could not be processed" % trip_id)
             traceback.print_exc()
-        '''
-        
-        split_route = os.path.join(SF_DIR, trip_id+"_observed_route.shp")
-        out_points_name = os.path.join(SF_DIR, trip_id+"_points.shp")
-        if os.path.exists(split_route) and os.path.exists(out_points_name):
-            add_stopsign_distances(out_points_name, split_route)
-            out_route_csv = os.path.join(OUTPUT_CSV_FOLDER, trip_id+".csv")
-            export_features_to_csv(out_points_name, out_route_csv)
         
         if (i + 1) % 10 == 0:
             print("Script has processed %d trips for %ds"
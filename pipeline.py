@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+"""Runs the speed analysis pipeline as a graph of cached stages
+
+Each stage declares the files it reads, the files it writes, its parameters
+and the source files that implement it. After a stage runs, its outputs are
+copied into a content-addressed cache keyed on a hash of all four, so a stage
+is only re-run when something it depends on has actually changed (e.g.
+changing the age KDE bandwidth re-runs the cleaning step, but not map
+matching). Stages whose inputs don't depend on each other run concurrently,
+and the least recently used cache entries are evicted once the cache grows
+past its disk budget.
+
+The runner itself runs under the analysis Python 3 environment; the arcpy
+scripts are run as subprocesses under the ArcGIS Python install.
+
+Usage: python pipeline.py [stage ...] [--force stage ...]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+DATA_DIR = "Data"
+CACHE_DIR = os.path.join(DATA_DIR, "Pipeline Cache")
+CACHE_BUDGET_GB = 20.0
+ARCGIS_PYTHON = r"C:\Python27\ArcGIS10.4\python.exe"
+JUPYTER = "jupyter"
+
+RAW_APP_DATA_DIR = r"C:\Users\Andrew\Documents\UofT2016\Bike App Data\Bike Data Original"
+CUT_DATA_DIR = os.path.join(DATA_DIR, "Cut Data")
+STOPS_XML = os.path.join(DATA_DIR, "Chapter_950", "Ch_950_Sch_27_CompulsoryStops.xml")
+FILTERED_STOPS_CSV = os.path.join(DATA_DIR, "Stop Signs (filtered).csv")
+STOPS_CSV = os.path.join(DATA_DIR, "Stop Signs.csv")
+UNMATCHED_STOPS_CSV = os.path.join(DATA_DIR, "Stop Signs (unmatched).csv")
+STOPS_GDB = os.path.join(DATA_DIR, "cycling-network.gdb")
+CENTRELINE_INTERSECTION = r"D:\UofT 2016\Bike App Data\Road - Intersections\CENTRELINE_INTERSECTION_simplified.shp"
+NETWORK_GDB = r"D:\UofT 2016\Kathryn Choiceset Generation\Network_with_Emme\CalibratedNetworkJuly26\CalibratedNetworkJuly26.gdb"
+PROCESSED_CSV_DIR = os.path.join(DATA_DIR, "Geoprocessed Data", "Processed CSVs")
+EMME_VOLUME_DATA = os.path.join(DATA_DIR, "EMME 2011 VOLUME SUMMARY.OCT2015.v2.csv")
+EMME_LINK_DATA = os.path.join(DATA_DIR, "EMME_link_data.csv")
+CLEANED_DATA_DIR = os.path.join(DATA_DIR, "Cleaned Data")
+CLEANED_DATA = os.path.join(CLEANED_DATA_DIR, "cleaned_data.csv")
+CLEANED_STORE_DIR = os.path.join(CLEANED_DATA_DIR, "cleaned_store")
+FINAL_CLEANED_DATA = os.path.join(CLEANED_DATA_DIR, "cleaned_data_final.csv")
+FINAL_STORE_DIR = os.path.join(CLEANED_DATA_DIR, "cleaned_store_final")
+MODEL_DIR = "Model Output"
+LINK_MODEL_DATA = os.path.join(MODEL_DIR, "link_with_model_data.csv")
+FOREST_RESULTS = os.path.join(MODEL_DIR, "random_forest_results.csv")
+
+
+class Stage(object):
+    """A single step of the pipeline
+
+    parameters
+    name: A unique name for the stage
+    run: A callable taking the stage's parameter dict, which writes the outputs
+    inputs: Paths (files or directories) read by the stage
+    outputs: Paths (files or directories) written by the stage
+    params: A JSON-serializable dict of parameters passed to run
+    code: Source files implementing the stage; editing one invalidates the cache
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), params=None, code=()):
+        self.name = name
+        self.run = run
+        self.inputs = [os.path.normpath(p) for p in inputs]
+        self.outputs = [os.path.normpath(p) for p in outputs]
+        self.params = params or {}
+        self.code = [os.path.normpath(p) for p in code]
+
+
+class DigestIndex(object):
+    """Content hashes of files, memoized on their size and modification time
+
+    Hashing every trip CSV on every run would dominate the runtime of a run
+    where nothing has changed, so digests are only recomputed for files whose
+    stat has changed since the last run.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        try:
+            with open(index_file) as f:
+                self.memo = json.load(f)
+        except (IOError, ValueError):
+            self.memo = {}
+
+    def file_digest(self, path):
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            cached = self.memo.get(path)
+        if cached is not None and cached[:2] == stamp:
+            return cached[2]
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        with self.lock:
+            self.memo[path] = stamp + [sha.hexdigest()]
+        return sha.hexdigest()
+
+    def path_digest(self, path):
+        """Returns a digest of a file or a whole directory tree, or None if missing"""
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        sha = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                sha.update(os.path.relpath(full_path, path).encode("utf8"))
+                sha.update(self.file_digest(full_path).encode("ascii"))
+        return sha.hexdigest()
+
+    def save(self):
+        with self.lock:
+            with open(self.index_file, "w") as f:
+                json.dump(self.memo, f)
+
+
+class StageCache(object):
+    """Content-addressed store of stage outputs with an LRU disk budget
+
+    Each entry is a directory named by the stage key, holding a copy of every
+    output and a manifest with the output digests and total size. The
+    manifest's modification time records when the entry was last used.
+    """
+
+    def __init__(self, cache_dir, budget_bytes):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.pinned = set()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _manifest_file(self, key):
+        return os.path.join(self.cache_dir, key, "manifest.json")
+
+    def lookup(self, key, stage):
+        try:
+            with open(self._manifest_file(key)) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if len(manifest.get("outputs", ())) != len(stage.outputs):
+            return None
+        with self.lock:
+            self.pinned.add(key)
+        os.utime(self._manifest_file(key), None)
+        return manifest
+
+    def restore(self, key, stage, manifest, digests):
+        """Copies cached outputs back into place, skipping any that already match"""
+        for i, output in enumerate(stage.outputs):
+            if digests.path_digest(output) == manifest["outputs"][i]:
+                continue
+            print("[%s] Restoring %s from cache" % (stage.name, output))
+            _remove_path(output)
+            _copy_path(os.path.join(self.cache_dir, key, str(i)), output)
+
+    def store(self, key, stage, digests):
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = entry_dir + ".tmp"
+        _remove_path(tmp_dir)
+        os.makedirs(tmp_dir)
+        output_digests = []
+        for i, output in enumerate(stage.outputs):
+            output_digests.append(digests.path_digest(output))
+            if output_digests[-1] is None:
+                shutil.rmtree(tmp_dir)
+                raise IOError("Stage %s did not write its output %s" % (stage.name, output))
+            _copy_path(output, os.path.join(tmp_dir, str(i)))
+        manifest = {"stage": stage.name, "outputs": output_digests,
+                    "size": _path_size(tmp_dir)}
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        _remove_path(entry_dir)
+        os.rename(tmp_dir, entry_dir)
+        with self.lock:
+            self.pinned.add(key)
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits its budget
+
+        Entries used during the current run are never evicted, and neither are
+        the temporary directories of entries still being stored.
+        """
+        with self.lock:
+            entries = []
+            for key in os.listdir(self.cache_dir):
+                if key.endswith(".tmp"):
+                    continue
+                try:
+                    with open(self._manifest_file(key)) as f:
+                        size = json.load(f)["size"]
+                except (IOError, ValueError, KeyError):
+                    continue
+                entries.append((os.path.getmtime(self._manifest_file(key)), key, size))
+            total = sum(size for _, _, size in entries)
+            for _, key, size in sorted(entries):
+                if total <= self.budget_bytes:
+                    break
+                if key in self.pinned:
+                    continue
+                print("Evicting cache entry %s (%0.1f MB)" % (key, size / 1e6))
+                shutil.rmtree(os.path.join(self.cache_dir, key))
+                total -= size
+
+
+class Pipeline(object):
+    """Runs a set of stages in dependency order, reusing cached outputs
+
+    A stage depends on another if one of its inputs is (or is inside) one of
+    the other stage's outputs.
+    """
+
+    def __init__(self, stages, cache_dir=CACHE_DIR, budget_gb=CACHE_BUDGET_GB, workers=4):
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.cache = StageCache(cache_dir, int(budget_gb * 1e9))
+        self.digests = DigestIndex(os.path.join(cache_dir, "digests.json"))
+        self.workers = workers
+        self.deps = dict((stage.name, self._find_deps(stage)) for stage in stages)
+
+    def _find_deps(self, stage):
+        deps = set()
+        for other in self.stages.values():
+            if other is stage:
+                continue
+            for inp in stage.inputs:
+                if any(inp == out or inp.startswith(out + os.sep) for out in other.outputs):
+                    deps.add(other.name)
+        return deps
+
+    def _with_ancestors(self, names):
+        selected = set()
+        to_visit = list(names)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in self.stages:
+                raise ValueError("Unknown stage %s" % name)
+            if name not in selected:
+                selected.add(name)
+                to_visit.extend(self.deps[name])
+        return selected
+
+    def stage_key(self, stage):
+        """Returns the cache key for a stage given the current state of its inputs"""
+        inputs = {}
+        for path in stage.inputs:
+            inputs[path] = self.digests.path_digest(path)
+            if inputs[path] is None:
+                raise IOError("Stage %s is missing its input %s" % (stage.name, path))
+        key_data = {"stage": stage.name,
+                    "params": stage.params,
+                    "outputs": stage.outputs,
+                    "code": dict((path, self.digests.path_digest(path)) for path in stage.code),
+                    "inputs": inputs}
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode("utf8")).hexdigest()
+
+    def _run_stage(self, stage, force):
+        key = self.stage_key(stage)
+        manifest = None if force else self.cache.lookup(key, stage)
+        if manifest is not None:
+            self.cache.restore(key, stage, manifest, self.digests)
+            print("[%s] Up to date" % stage.name)
+            return
+        print("[%s] Running" % stage.name)
+        start_t = time.time()
+        stage.run(stage.params)
+        self.cache.store(key, stage, self.digests)
+        print("[%s] Finished in %ds" % (stage.name, time.time() - start_t))
+
+    def run(self, targets=None, force=()):
+        """Brings the target stages (and everything upstream) up to date
+
+        parameters
+        targets: Names of the stages to run; defaults to every stage
+        force: Names of stages to re-run even if their outputs are cached
+        """
+        pending = self._with_ancestors(targets or self.stages.keys())
+        done = set()
+        running = {}
+        try:
+            # On a failure, no new stages are started, but stages that are
+            # already running are allowed to finish
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while pending or running:
+                    ready = [name for name in pending if self.deps[name] <= done]
+                    for name in ready:
+                        pending.remove(name)
+                        future = executor.submit(self._run_stage, self.stages[name], name in force)
+                        running[future] = name
+                    if not running:
+                        raise ValueError("Stages %s have a circular dependency"
+                                         % ", ".join(sorted(pending)))
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        future.result()
+                        done.add(name)
+        finally:
+            self.digests.save()
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _copy_path(src, dst):
+    parent = os.path.dirname(dst)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def _path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def _script_env(paths):
+    """Returns the environment for a script, with the paths it reads and writes
+
+    The scripts and notebooks read their data paths from these environment
+    variables (falling back to their own defaults when run by hand), so the
+    paths a stage declares are the ones it actually uses.
+    """
+    env = dict(os.environ)
+    env.update((name, os.path.abspath(path)) for name, path in paths.items())
+    return env
+
+
+def arcgis_script(script, paths, python=ARCGIS_PYTHON):
+    """Returns a stage runner executing a script under the ArcGIS Python"""
+    def run(params):
+        subprocess.check_call([python, script], env=_script_env(paths))
+    return run
+
+
+def notebook(notebook_file, paths):
+    """Returns a stage runner executing a notebook top to bottom"""
+    def run(params):
+        out_dir = tempfile.mkdtemp()
+        try:
+            subprocess.check_call([JUPYTER, "nbconvert", "--to", "notebook", "--execute",
+                                   "--ExecutePreprocessor.timeout=-1",
+                                   "--output-dir", out_dir, notebook_file],
+                                  env=_script_env(paths))
+        finally:
+            shutil.rmtree(out_dir)
+    return run
+
+
+def clean_stage(params):
+    import clean_data
+    if not os.path.exists(CLEANED_DATA_DIR):
+        os.makedirs(CLEANED_DATA_DIR)
+    clean_data.clean_trips(PROCESSED_CSV_DIR, cache_file=CLEANED_DATA,
+                           age_bandwidth=params["age_bandwidth"],
+                           store_dir=CLEANED_STORE_DIR)
+
+
+def forest_stage(params):
+    import speed_models
+    speed_models.evaluate_speed_forest(FINAL_STORE_DIR, FOREST_RESULTS, **params)
+
+
+def build_stages(age_bandwidth=5.0, arcgis_python=ARCGIS_PYTHON):
+    """Returns the stages of the full pipeline, from raw app data to the analysis notebook"""
+    return [
+        Stage("cut_trips", notebook("Data Cleaning.ipynb",
+                                    {"RAW_APP_DATA_DIR": RAW_APP_DATA_DIR,
+                                     "CUT_DATA_DIR": CUT_DATA_DIR}),
+              inputs=[RAW_APP_DATA_DIR],
+              outputs=[CUT_DATA_DIR],
+              code=["Data Cleaning.ipynb"]),
+        Stage("stop_signs", arcgis_script("data_aggregation.py",
+                                          {"STOPS_XML": STOPS_XML,
+                                           "FILTERED_STOPS_CSV": FILTERED_STOPS_CSV,
+                                           "CENTRELINE_INTERSECTION": CENTRELINE_INTERSECTION,
+                                           "STOPS_CSV": STOPS_CSV,
+                                           "UNMATCHED_STOPS_CSV": UNMATCHED_STOPS_CSV,
+                                           "STOPS_GDB": STOPS_GDB},
+                                          arcgis_python),
+              inputs=[STOPS_XML, FILTERED_STOPS_CSV, CENTRELINE_INTERSECTION],
+              outputs=[STOPS_CSV, UNMATCHED_STOPS_CSV, STOPS_GDB],
+              code=["data_aggregation.py"]),
+        Stage("map_match", arcgis_script("gps_data_join.py",
+                                         {"CUT_DATA_DIR": CUT_DATA_DIR,
+                                          "NETWORK_GDB": NETWORK_GDB,
+                                          "PROCESSED_CSV_DIR": PROCESSED_CSV_DIR},
+                                         arcgis_python),
+              inputs=[CUT_DATA_DIR, NETWORK_GDB],
+              outputs=[PROCESSED_CSV_DIR],
+              code=["gps_data_join.py"]),
+        Stage("clean", clean_stage,
+              inputs=[PROCESSED_CSV_DIR, EMME_VOLUME_DATA, EMME_LINK_DATA],
+              outputs=[CLEANED_DATA, CLEANED_STORE_DIR],
+              params={"age_bandwidth": age_bandwidth},
+              code=["clean_data.py", "point_store.py"]),
+        Stage("analysis", notebook("Speed Analysis.ipynb",
+                                   {"PROCESSED_CSV_DIR": PROCESSED_CSV_DIR,
+                                    "EMME_VOLUME_DATA": EMME_VOLUME_DATA,
+                                    "EMME_LINK_DATA": EMME_LINK_DATA,
+                                    "CLEANED_DATA_DIR": CLEANED_DATA_DIR,
+                                    "MODEL_DIR": MODEL_DIR}),
+              inputs=[PROCESSED_CSV_DIR, EMME_VOLUME_DATA, EMME_LINK_DATA],
+              outputs=[FINAL_CLEANED_DATA, FINAL_STORE_DIR, LINK_MODEL_DATA],
+              code=["Speed Analysis.ipynb", "point_store.py", "speed_models.py",
+                    "density_plots.py"]),
+        Stage("random_forest", forest_stage,
+              inputs=[FINAL_STORE_DIR],
+              outputs=[FOREST_RESULTS],
+              params={"n_estimators": 100, "group_col": "APP_USER_I"},
+              code=["speed_models.py", "point_store.py"]),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("targets", nargs="*", help="Stages to bring up to date (default: all)")
+    parser.add_argument("--force", nargs="+", default=[], help="Stages to re-run regardless of the cache")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--cache-budget-gb", type=float, default=CACHE_BUDGET_GB)
+    parser.add_argument("--age-bandwidth", type=float, default=5.0)
+    parser.add_argument("--arcgis-python", default=ARCGIS_PYTHON)
+    args = parser.parse_args()
+
+    stages = build_stages(age_bandwidth=args.age_bandwidth, arcgis_python=args.arcgis_python)
+    pipeline = Pipeline(stages, budget_gb=args.cache_budget_gb, workers=args.workers)
+    start_t = time.time()
+    pipeline.run(targets=args.targets, force=set(args.force))
+    print("Pipeline took %ds" % (time.time() - start_t))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Memory-mapped columnar storage for the cleaned point data
+
+A store is a directory holding one .npy file per column plus a small
+meta.json header with the column files, dtypes, the categories of string
+columns and the row offsets of each trip and user. Rows are sorted by user,
+trip and time, so every trip and user is a contiguous range of rows.
+
+Opening a store only reads the header. Columns are memory-mapped read-only
+when first used, so a query only pages in the columns and rows it touches,
+and every process on the machine reading the same store shares one copy of
+the data through the OS page cache.
+"""
+
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_numeric_dtype
+
+META_FILE = "meta.json"
+SORT_COLUMNS = ("APP_USER_I", "TRIP_ID", "RECORDED_A")
+
+
+def write_store(df, store_dir):
+    """Writes a dataframe of points to a columnar store
+
+    Any column that isn't numeric, boolean or a datetime (strings, objects,
+    categoricals) is stored as integer codes, with the categories kept in
+    the header (missing values get the code -1).
+    The dataframe must have APP_USER_I and TRIP_ID columns.
+
+    The columns are written to a temporary directory first, under file names
+    new to this write, then moved in and the header replaced, so a store that
+    is open (and memory-mapped) elsewhere is never written over. Column files
+    no longer in the header are removed afterwards, except those still mapped
+    on Windows, which go on the next write.
+    """
+    tmp_dir = store_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    generation = uuid.uuid4().hex[:8]
+    sort_cols = [col for col in SORT_COLUMNS if col in df.columns]
+    df = df.sort_values(sort_cols).reset_index(drop=True)
+
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        categories = None
+        if not (is_numeric_dtype(values) or is_datetime64_any_dtype(values)):
+            categorical = pd.Categorical(values.astype(str).where(values.notnull()))
+            categories = [str(c) for c in categorical.categories]
+            codes_dtype = np.int16 if len(categories) < 2**15 else np.int32
+            array = categorical.codes.astype(codes_dtype)
+        else:
+            array = np.ascontiguousarray(values.to_numpy())
+            if array.dtype == object:
+                # e.g. a nullable integer column with missing values
+                raise TypeError("Column %s has dtype %s, which can't be memory-mapped"
+                                % (col, values.dtype))
+        col_file = "%s.%s.npy" % (col, generation)
+        np.save(os.path.join(tmp_dir, col_file), array)
+        columns[col] = {"file": col_file, "dtype": str(array.dtype), "categories": categories}
+
+    meta = {"n_rows": len(df),
+            "columns": columns,
+            "order": list(df.columns),
+            "trips": _group_offsets(df["TRIP_ID"].values),
+            "users": _group_offsets(df["APP_USER_I"].values)}
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+    if not os.path.exists(store_dir):
+        os.rename(tmp_dir, store_dir)
+        return
+    for col_info in columns.values():
+        os.replace(os.path.join(tmp_dir, col_info["file"]),
+                   os.path.join(store_dir, col_info["file"]))
+    os.replace(os.path.join(tmp_dir, META_FILE), os.path.join(store_dir, META_FILE))
+    os.rmdir(tmp_dir)
+
+    current_files = set(col_info["file"] for col_info in columns.values())
+    current_files.add(META_FILE)
+    for name in os.listdir(store_dir):
+        if name not in current_files:
+            try:
+                os.remove(os.path.join(store_dir, name))
+            except OSError:
+                pass
+
+
+def _group_offsets(sorted_ids):
+    """Returns the ids of each run of equal values and the offsets where the runs start"""
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    return {"ids": [_to_json(v) for v in sorted_ids[starts]],
+            "offsets": [int(s) for s in starts] + [len(sorted_ids)]}
+
+
+def _to_json(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+class PointStore(object):
+    """A read-only handle on a columnar point store"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+        self._trip_index = dict((trip_id, i) for i, trip_id
+                                in enumerate(self.meta["trips"]["ids"]))
+        self._user_index = dict((user_id, i) for i, user_id
+                                in enumerate(self.meta["users"]["ids"]))
+
+    def __len__(self):
+        return self.meta["n_rows"]
+
+    @property
+    def columns(self):
+        return list(self.meta["order"])
+
+    def categories(self, col):
+        """Returns the categories of a string column, or None for other columns"""
+        return self.meta["columns"][col]["categories"]
+
+    def column_path(self, col):
+        """Returns the path of a column's file"""
+        return os.path.join(self.store_dir, self.meta["columns"][col]["file"])
+
+    def array(self, col):
+        """Returns the raw memory-mapped array for a column (codes for string columns)"""
+        if col not in self._arrays:
+            if col not in self.meta["columns"]:
+                raise KeyError("Column %s is not in the store at %s" % (col, self.store_dir))
+            self._arrays[col] = np.load(self.column_path(col), mmap_mode="r")
+        return self._arrays[col]
+
+    def column(self, col, rows=slice(None)):
+        """Returns a column as a pandas Series, decoding string columns to categoricals"""
+        values = self.array(col)[rows]
+        categories = self.categories(col)
+        if categories is not None:
+            values = pd.Categorical.from_codes(values, categories)
+        return pd.Series(values, name=col)
+
+    def trip_rows(self, trip_id):
+        """Returns a slice of the rows belonging to a trip"""
+        return self._group_slice(self.meta["trips"], self._trip_index[trip_id])
+
+    def user_rows(self, user_id):
+        """Returns a slice of the rows belonging to a user"""
+        return self._group_slice(self.meta["users"], self._user_index[user_id])
+
+    @staticmethod
+    def _group_slice(groups, i):
+        return slice(groups["offsets"][i], groups["offsets"][i + 1])
+
+    def group_sizes(self, by="TRIP_ID"):
+        """Returns a Series of the number of rows for each trip (or user, by="APP_USER_I")"""
+        if by == "TRIP_ID":
+            groups = self.meta["trips"]
+        elif by == "APP_USER_I":
+            groups = self.meta["users"]
+        else:
+            raise ValueError("Can only group a store by TRIP_ID or APP_USER_I, not %s" % by)
+        return pd.Series(np.diff(groups["offsets"]), index=groups["ids"])
+
+    def to_frame(self, columns=None, rows=slice(None)):
+        """Reads the given columns and rows into an in-memory dataframe"""
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame(dict((col, self.column(col, rows)) for col in columns),
+                            columns=columns)
+
+
+def open_store(store_dir):
+    return PointStore(store_dir)
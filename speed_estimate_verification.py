@@ -21,6 +21,8 @@ import os
 import re
 import scipy.stats
 
+import density_plots
+
 EARTH_RADIUS_M = 6371000
 
 
@@ -118,8 +120,15 @@ if __name__ == '__main__':
     print("GPS estimate = %f * app estimate + %f" % (slope, intercept))
     print("R-squared: %f\tSignificant at the %f level with standard error %f" % (r_sq, p_val, stderr))
 
-    plt.scatter(app_estimates, gps_estimates)
-    #plt.hexbin(app_estimates, gps_estimates, bins='log', cmap=plt.cm.Blues)
+    # Both axes cover the same speeds, up to the 99.9th percentile of either
+    # estimate, so a handful of wild GPS speeds don't squash the plot
+    max_speed = np.nanpercentile(np.concatenate((app_estimates, gps_estimates)), 99.9)
+    grid = density_plots.bin_points(app_estimates, gps_estimates, (0, max_speed), (0, max_speed))
+    print("%d of %d speed estimates fall outside the plotted range of 0 to %0.1f m/s"
+          % (len(app_estimates) - grid.counts.sum(), len(app_estimates), max_speed))
+    mesh = density_plots.plot_density(grid, cmap=plt.cm.Blues)
+    cbar = plt.colorbar(mesh)
+    cbar.set_label("Counts")
     plt.xlabel("Speed estimate from app (m/s)")
     plt.ylabel("Speed estimate from GPS data (m/s)")
     #plt.show()
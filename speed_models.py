@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""Trains and evaluates random forest speed models on the full cleaned dataset
+
+Feature matrices are built once as float32 (the dtype sklearn's trees
+work in, so fitting doesn't make another copy) straight from the columns
+of a point store, a chunk at a time. Train, validation and test splits are
+made by user (or trip), so no rider's points end up on both sides of a
+split, and forests train across all cores.
+"""
+
+import csv
+import os
+import time
+
+import numpy as np
+from sklearn import ensemble
+from sklearn import model_selection
+
+import point_store
+
+CLEANED_DATA_DIR = os.path.join("Data", "Cleaned Data")
+FINAL_STORE_DIR = os.path.join(CLEANED_DATA_DIR, "cleaned_store_final")
+MODEL_DIR = "Model Output"
+RESULTS_FILE = os.path.join(MODEL_DIR, "random_forest_results.csv")
+
+ROAD_FEATURES = ("bike_lanes", "sharrows", "bike_path", "SIG_DIST",
+                 "volume", "speed_limit", "LANES", "RDCLASS", "lane_cap")
+TARGET = "SPEED"
+CHUNK_SIZE = 1000000
+
+
+def _chunks(n_rows, chunk_size=CHUNK_SIZE):
+    return [slice(start, min(start + chunk_size, n_rows))
+            for start in range(0, n_rows, chunk_size)]
+
+
+def valid_rows(store, features=ROAD_FEATURES, target=TARGET):
+    """Returns the store rows where none of the features or the target are missing"""
+    columns = [store.array(col) for col in features] + [store.array(target)]
+    valid = np.ones(len(store), dtype=bool)
+    for rows in _chunks(len(store)):
+        for col in columns:
+            if col.dtype.kind == "f":
+                valid[rows] &= np.isfinite(col[rows])
+    return np.flatnonzero(valid)
+
+
+def feature_matrix(store, features=ROAD_FEATURES, target=TARGET, rows=None):
+    """Returns a float32 feature matrix, the target and the store rows they came from
+
+    The matrix holds the given store rows in the given order (by default
+    every row with no missing feature or target). It is allocated once and
+    filled a chunk at a time from the memory-mapped columns, so peak memory
+    is the matrix plus one chunk.
+    """
+    if rows is None:
+        rows = valid_rows(store, features, target)
+    columns = [store.array(col) for col in features]
+    target_col = store.array(target)
+
+    X = np.empty((len(rows), len(features)), dtype=np.float32)
+    y = np.empty(len(rows), dtype=np.float64)
+    for chunk in _chunks(len(rows)):
+        chunk_rows = rows[chunk]
+        for j, col in enumerate(columns):
+            X[chunk, j] = col[chunk_rows]
+        y[chunk] = target_col[chunk_rows]
+    return X, y, rows
+
+
+def group_split(groups, fractions=(0.6, 0.2, 0.2), seed=0):
+    """Splits rows into disjoint sets that never share a group (a user or trip)
+
+    Groups are shuffled and assigned to each split until it holds roughly
+    its fraction of the rows. Returns an array of row indices per split.
+    Raises a ValueError if there are too few groups to fill every split.
+    """
+    unique_groups, group_index, group_sizes = np.unique(groups, return_inverse=True,
+                                                        return_counts=True)
+    order = np.random.RandomState(seed).permutation(len(unique_groups))
+    cumulative_rows = np.cumsum(group_sizes[order])
+    boundaries = np.cumsum(fractions)[:-1] / np.sum(fractions) * cumulative_rows[-1]
+    split_of_group = np.empty(len(unique_groups), dtype=np.intp)
+    split_of_group[order] = np.searchsorted(boundaries, cumulative_rows, side="left")
+    row_split = split_of_group[group_index]
+    splits = [np.flatnonzero(row_split == i) for i in range(len(fractions))]
+    if any(len(split) == 0 for split in splits):
+        raise ValueError("Can't split %d groups into %d non-empty splits with fractions %s"
+                         % (len(unique_groups), len(fractions), fractions))
+    return splits
+
+
+def split_feature_matrix(store, features=ROAD_FEATURES, target=TARGET, group_col="APP_USER_I",
+                         fractions=(0.6, 0.2, 0.2), seed=0):
+    """Returns a feature matrix with its rows ordered by split, and a slice for each split
+
+    The rows are split by group_col with group_split and the matrix is
+    filled in split order, so each split is a contiguous view of X and y
+    rather than a copy. Also returns the group of each row.
+    """
+    rows = valid_rows(store, features, target)
+    groups = store.array(group_col)[rows]
+    splits = group_split(groups, fractions, seed)
+    order = np.concatenate(splits)
+    rows, groups = rows[order], groups[order]
+    X, y, _ = feature_matrix(store, features, target, rows)
+    ends = np.cumsum([len(split) for split in splits])
+    split_slices = [slice(int(start), int(end)) for start, end in zip(np.r_[0, ends[:-1]], ends)]
+    return X, y, groups, split_slices
+
+
+def train_forest(X, y, n_estimators=100, min_samples_leaf=20, n_jobs=-1, seed=0):
+    """Fits a random forest across all cores and reports how long it took
+
+    min_samples_leaf keeps the trees (and so the forest's memory) from
+    growing with the size of the full dataset.
+    """
+    model = ensemble.RandomForestRegressor(n_estimators=n_estimators,
+                                           min_samples_leaf=min_samples_leaf,
+                                           n_jobs=n_jobs, random_state=seed)
+    start_t = time.time()
+    model.fit(X, y)
+    elapsed = time.time() - start_t
+    print("Fit %d trees on %d rows in %0.1fs (%d rows/s)"
+          % (n_estimators, len(y), elapsed, len(y) / max(elapsed, 1e-9)))
+    return model
+
+
+def score(model, X, y):
+    """Returns the R^2 of a model, predicting a chunk at a time (NaN if there are no rows)"""
+    if len(y) == 0:
+        return np.nan
+    start_t = time.time()
+    predicted = np.concatenate([model.predict(X[rows]) for rows in _chunks(len(y))])
+    elapsed = time.time() - start_t
+    print("Predicted %d rows in %0.1fs (%d rows/s)" % (len(y), elapsed, len(y) / max(elapsed, 1e-9)))
+    return 1 - np.sum((y - predicted)**2) / np.sum((y - y.mean())**2)
+
+
+def cross_validate(X, y, groups, n_splits=5, **forest_args):
+    """Returns the R^2 of each fold of a k-fold cross validation grouped by user or trip
+
+    Folds are fit one after another, each across all cores, so only one
+    forest is in memory at a time.
+    """
+    scores = []
+    folds = model_selection.GroupKFold(n_splits=n_splits).split(X, y, groups)
+    for i, (train_rows, test_rows) in enumerate(folds):
+        print("Cross validation fold %d of %d" % (i + 1, n_splits))
+        model = train_forest(X[train_rows], y[train_rows], **forest_args)
+        scores.append(score(model, X[test_rows], y[test_rows]))
+        model = None
+    return scores
+
+
+def evaluate_speed_forest(store_dir=FINAL_STORE_DIR, results_file=RESULTS_FILE,
+                          features=ROAD_FEATURES, group_col="APP_USER_I", n_splits=5,
+                          **forest_args):
+    """Trains a forest on the full dataset and writes its scores and feature importances
+
+    The forest is fit on the training split, scored on the validation and
+    test splits, and cross validated over the training and validation
+    splits; every split is grouped by group_col.
+    """
+    store = point_store.open_store(store_dir)
+    start_t = time.time()
+    X, y, groups, (train, validation, test) = split_feature_matrix(store, features,
+                                                                   group_col=group_col)
+    print("Built %d x %d feature matrix in %0.1fs" % (X.shape[0], X.shape[1], time.time() - start_t))
+
+    model = train_forest(X[train], y[train], **forest_args)
+    results = [("Validation R^2", score(model, X[validation], y[validation])),
+               ("Test R^2", score(model, X[test], y[test]))]
+    results += [("Importance of %s" % feature, importance)
+                for feature, importance in zip(features, model.feature_importances_)]
+    model = None
+
+    cv_rows = slice(0, validation.stop)
+    cv_scores = cross_validate(X[cv_rows], y[cv_rows], groups[cv_rows], n_splits, **forest_args)
+    results += [("CV fold %d R^2" % (i + 1), s) for i, s in enumerate(cv_scores)]
+    results.append(("Mean CV R^2", np.mean(cv_scores)))
+
+    if not os.path.exists(os.path.dirname(results_file)):
+        os.makedirs(os.path.dirname(results_file))
+    with open(results_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("Statistic", "Value"))
+        writer.writerows(results)
+    for name, value in results:
+        print("%s: %f" % (name, value))
+    return results
+
+
+if __name__ == "__main__":
+    evaluate_speed_forest()